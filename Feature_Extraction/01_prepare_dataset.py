@@ -1,8 +1,23 @@
 # 01_prepare_dataset.py
 import os
-import pandas as pd
+import csv
+import pickle
 import shutil
 
+def link_or_copy(src, dst):
+    """
+    Hardlinks src to dst, falling back to a plain byte copy when the two
+    paths are on different filesystems. File metadata is not preserved.
+    """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        # Replace the copy left over from a previous run
+        os.remove(dst)
+        link_or_copy(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
 def prepare_dataset():
     """
     Finds all .cif and .json files in the source dataset folders,
@@ -25,6 +40,7 @@ def prepare_dataset():
     cif_out_dir = os.path.join(project_dir, "cifs")
     json_out_dir = os.path.join(project_dir, "jsons")
     output_csv = os.path.join(project_dir, "mof_master_list.csv")
+    cif_index_path = os.path.join(project_dir, "cif_index.pkl")
 
     # Create directories if they don't exist
     os.makedirs(cif_out_dir, exist_ok=True)
@@ -38,18 +54,23 @@ def prepare_dataset():
             continue
 
         print(f"🔍 Searching in: {folder}...")
-        for file in os.listdir(folder):
+        # A single scandir pass gives us every file name for O(1) JSON lookups
+        with os.scandir(folder) as it:
+            entries = [entry for entry in it if entry.is_file()]
+        file_names = {entry.name for entry in entries}
+
+        for entry in entries:
+            file = entry.name
             if file.endswith(".cif"):
                 mof_id = os.path.splitext(file)[0]
                 json_name = f"{mof_id}.json"
-                cif_path = os.path.join(folder, file)
                 json_path = os.path.join(folder, json_name)
 
                 # Ensure a matching JSON file exists before adding
-                if os.path.exists(json_path):
+                if json_name in file_names:
                     # Copy files to the centralized project folders
-                    shutil.copy2(cif_path, os.path.join(cif_out_dir, file))
-                    shutil.copy2(json_path, os.path.join(json_out_dir, json_name))
+                    link_or_copy(entry.path, os.path.join(cif_out_dir, file))
+                    link_or_copy(json_path, os.path.join(json_out_dir, json_name))
 
                     # Add a record for the master CSV file
                     records.append({
@@ -66,12 +87,19 @@ def prepare_dataset():
         print("\n❌ Error: No matching .cif/.json pairs were found. Please check your `input_folders` paths.")
         return
 
-    df = pd.DataFrame(records)
-    df.to_csv(output_csv, index=False)
+    with open(output_csv, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["MOF_ID", "dataset_origin", "path_to_cif", "path_to_json"])
+        writer.writeheader()
+        writer.writerows(records)
+
+    # Save the set of copied MOF IDs so later steps can skip re-checking the CIF folder
+    with open(cif_index_path, "wb") as f:
+        pickle.dump({record["MOF_ID"] for record in records}, f)
 
     print(f"\n✅ Finished! Found and organized {len(records)} MOFs.")
     print(f"   - CIFs and JSONs copied to '{project_dir}/'")
     print(f"   - Master list saved to: '{output_csv}'")
+    print(f"   - CIF index saved to: '{cif_index_path}'")
 
 if __name__ == "__main__":
     prepare_dataset()
\ No newline at end of file
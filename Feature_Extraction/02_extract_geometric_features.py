@@ -1,9 +1,37 @@
 # 02_extract_geometric_features.py
 import os
-import json
+import orjson
 import pandas as pd
-import matplotlib.pyplot as plt
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from fs_utils import iter_files
+
+# Define the specific geometric keys to extract from the JSON files
+FEATURE_KEYS = [
+    "surface_area_m2g",
+    "surface_area_m2cm3",
+    "void_fraction",
+    "pld",
+    "lcd",
+]
+
+# Output column order and dtypes of the geometric feature table
+GEOMETRIC_DTYPES = {"MOF_ID": "object", **{key: "float64" for key in FEATURE_KEYS}}
+
+def read_geometric_json(json_file_tuple):
+    """
+    Reads a single JSON file and returns its geometric feature row.
+    Designed to be run in parallel.
+    """
+    filename, json_path = json_file_tuple
+    mof_id = filename.replace(".json", "")
+    try:
+        with open(json_path, "rb") as f:
+            json_data = orjson.loads(f.read())
+        row = {"MOF_ID": mof_id}
+        row.update({key: json_data.get(key) for key in FEATURE_KEYS})
+        return row, None
+    except Exception as e:
+        return None, (filename, str(e))
 
 def extract_geometric_features():
     """
@@ -17,15 +45,7 @@ def extract_geometric_features():
     json_folder = os.path.join("MOFxDB_Project", "jsons")
     output_dir = os.path.join("MOFxDB_Project", "features", "geometric")
     output_csv = os.path.join(output_dir, "geometric_features.csv")
-
-    # Define the specific geometric keys to extract from the JSON files
-    feature_keys = [
-        "surface_area_m2g",
-        "surface_area_m2cm3",
-        "void_fraction",
-        "pld",
-        "lcd",
-    ]
+    N_WORKERS = max(1, (os.cpu_count() or 1) - 1)
 
     # --- PREPARATION ---
     if not os.path.isdir(json_folder):
@@ -35,50 +55,48 @@ def extract_geometric_features():
 
     os.makedirs(output_dir, exist_ok=True)
     data = []
-    missing_counts = defaultdict(int)
 
     # --- PROCESS JSON FILES ---
-    json_files = [f for f in os.listdir(json_folder) if f.endswith(".json")]
+    json_files = list(iter_files(json_folder, ".json"))
     print(f"🔍 Found {len(json_files)} JSON files to process.")
 
-    for filename in json_files:
-        json_path = os.path.join(json_folder, filename)
-        mof_id = filename.replace(".json", "")
-        try:
-            with open(json_path, "r") as f:
-                json_data = json.load(f)
-
-            row = {"MOF_ID": mof_id}
-            for key in feature_keys:
-                value = json_data.get(key)
-                if value is None:
-                    missing_counts[key] += 1
-                row[key] = value
-            data.append(row)
-
-        except Exception as e:
-            print(f"⚠️ Error processing {filename}: {e}")
+    # Batch the small JSON reads so inter-process overhead doesn't dominate
+    chunksize = max(1, len(json_files) // (N_WORKERS * 8))
+    with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
+        for row, error in executor.map(read_geometric_json, json_files, chunksize=chunksize):
+            if row:
+                data.append(row)
+            if error:
+                print(f"⚠️ Error processing {error[0]}: {error[1]}")
 
     # --- SAVE CSV ---
     if not data:
         print("❌ Error: No data was extracted. Check the JSON files for content.")
         return
 
-    df = pd.DataFrame(data)
+    df = pd.DataFrame.from_records(data, columns=list(GEOMETRIC_DTYPES))
+    # Non-numeric entries (e.g. "N/A") become NaN and are reported as missing below
+    df[FEATURE_KEYS] = df[FEATURE_KEYS].apply(pd.to_numeric, errors="coerce")
+    df = df.astype(GEOMETRIC_DTYPES)
     df.to_csv(output_csv, index=False)
     print(f"\n✅ Geometric features saved to: '{output_csv}'")
 
     # --- PLOT MISSING DATA ---
-    if missing_counts:
+    missing_counts = df[FEATURE_KEYS].isna().sum()
+    missing_counts = missing_counts[missing_counts > 0]
+    if not missing_counts.empty:
         print("\n📊 Plotting summary of missing features...")
+        import matplotlib.pyplot as plt  # Only imported when there is something to plot
         plt.figure(figsize=(10, 5))
-        plt.bar(missing_counts.keys(), missing_counts.values(), color='skyblue')
+        plt.bar(missing_counts.index, missing_counts.values, color='skyblue')
         plt.ylabel("Number of Missing Values")
         plt.title("Missing Geometric Features Across All MOFs")
         plt.xticks(rotation=45, ha="right")
         plt.tight_layout()
         plt.savefig(os.path.join(output_dir, "missing_geometric_features.png"))
-        plt.show()
+        # Showing the plot blocks headless runs, so it is opt-in via SHOW_PLOT=1
+        if os.environ.get("SHOW_PLOT", "") not in ("", "0"):
+            plt.show()
     else:
         print("[✓] No missing geometric features were detected.")
 
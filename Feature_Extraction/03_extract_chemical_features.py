@@ -1,49 +1,117 @@
 # 03_extract_chemical_features.py
 import os
-import pandas as pd
+import csv
 import numpy as np
 import warnings
+from multiprocessing import shared_memory
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from pymatgen.core import Structure, Element
+from fs_utils import iter_files, blank_nan
+from cif_io import read_cif_arrays, save_structure_arrays, task_chunksize, get_mp_context
+from concurrent.futures import ProcessPoolExecutor
+from pymatgen.core import Structure, Lattice, Composition, Element
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 
 # Suppress Pymatgen warnings for cleaner output
 warnings.filterwarnings("ignore", category=UserWarning)
 
-def is_metal(symbol):
-    """Checks if an element symbol corresponds to a metal commonly found in MOFs."""
-    try:
-        element = Element(symbol)
-        return element.is_transition_metal or element.is_alkaline or element.is_alkali or element.is_post_transition_metal or element.is_lanthanoid
-    except:
-        return False
+# Converts a density in amu/Å^3 to g/cm^3
+AMU_PER_A3_TO_G_PER_CM3 = 1.66053906660
+
+# Atomic number of every element symbol, used to index the electronegativity table
+SYMBOL_TO_Z = {el.symbol: el.Z for el in Element}
+
+# Electronegativity by atomic number. Built once in the parent and shared with the
+# workers through shared memory, which they attach to in _worker_init.
+EN_TABLE = None
+_EN_SHM = None
+
+# Common metals that are one-hot encoded in the output
+COMMON_METALS = ["Zn", "Cu", "Zr", "Fe", "Co", "Ni", "Mn", "Cr", "V", "Al", "Mg", "Ca"]
+
+# Output column order of the chemical feature table
+CHEMICAL_COLUMNS = [
+    "MOF_ID",
+    "formula",
+    "num_atoms",
+    "volume",
+    "density",
+    "avg_electronegativity",
+    "electronegativity_variance",
+    "metal_fraction",
+    "num_unique_elements",
+    "metal_atom_count",
+    "space_group",
+    "space_group_number",
+] + [f"metal_{metal}" for metal in COMMON_METALS]
+
+# Symbols of the metals commonly found in MOFs, precomputed once at import
+_METAL_SYMBOLS = frozenset(
+    el.symbol for el in Element
+    if el.is_transition_metal or el.is_alkaline or el.is_alkali or el.is_post_transition_metal or el.is_lanthanoid
+)
+
+# Checks if an element symbol corresponds to a metal commonly found in MOFs
+is_metal = _METAL_SYMBOLS.__contains__
+
+def build_en_table():
+    """Returns the Pauling electronegativities indexed by atomic number (NaN where undefined)."""
+    en_table = np.full(max(SYMBOL_TO_Z.values()) + 1, np.nan, dtype=np.float64)
+    for el in Element:
+        en_table[el.Z] = el.X
+    return en_table
+
+def _warm_up():
+    """
+    Warms up pymatgen's lazily loaded element data and spglib so the first
+    task in each worker doesn't pay for it.
+    """
+    Element("C").X
+    SpacegroupAnalyzer(Structure(Lattice.cubic(3.0), ["C"], [[0, 0, 0]])).get_space_group_symbol()
+
+def _worker_init(en_shm_name, en_table_size, warm_up):
+    """
+    Attaches the worker to the shared electronegativity table. Workers that weren't
+    forked from the warmed-up parent also warm up their own state.
+    """
+    global EN_TABLE, _EN_SHM
+    _EN_SHM = shared_memory.SharedMemory(name=en_shm_name)
+    EN_TABLE = np.ndarray((en_table_size,), dtype=np.float64, buffer=_EN_SHM.buf)
+    if warm_up:
+        _warm_up()
 
 def process_cif(cif_path_tuple):
     """
     Processes a single CIF file to extract a wide range of chemical features.
     Designed to be run in parallel.
     """
-    cif_folder, filename = cif_path_tuple
+    cif_folder, filename, cache_dir = cif_path_tuple
     mof_id = filename.replace(".cif", "")
     cif_path = os.path.join(cif_folder, filename)
 
     try:
         # Load structure and composition
-        structure = Structure.from_file(cif_path)
-        comp = structure.composition
-        el_amt = dict(comp.get_el_amt_dict())
-        total_atoms = sum(el_amt.values())
+        lattice_matrix, species, frac_coords, occupancies = read_cif_arrays(cif_path)
+        # Weight each site by its occupancy so partially occupied sites aren't counted as full atoms
+        symbols, inverse = np.unique(species, return_inverse=True)
+        counts = np.bincount(inverse, weights=occupancies)
+        el_amt = dict(zip(symbols.tolist(), counts.tolist()))
+        comp = Composition(el_amt)
+        total_atoms = occupancies.sum()
 
         # Calculate features
-        volume = structure.volume
-        density = structure.density
+        volume = abs(np.linalg.det(lattice_matrix))
+        density = float(comp.weight) / volume * AMU_PER_A3_TO_G_PER_CM3
 
         # Electronegativity features
-        en_values = [Element(el).X for el, w in el_amt.items() if Element(el).X is not None]
-        en_weights = [w for el, w in el_amt.items() if Element(el).X is not None]
-        avg_en = np.average(en_values, weights=en_weights) if en_values else np.nan
-        var_en = np.average([(x - avg_en) ** 2 for x in en_values], weights=en_weights) if en_values else np.nan
+        idx = np.fromiter((SYMBOL_TO_Z[el] for el in el_amt), dtype=np.int32, count=len(el_amt))
+        en = EN_TABLE[idx]
+        mask = ~np.isnan(en)
+        en, weights = en[mask], counts[mask]
+        if en.size:
+            avg_en = (weights * en).sum() / weights.sum()
+            var_en = (weights * (en - avg_en) ** 2).sum() / weights.sum()
+        else:
+            avg_en, var_en = np.nan, np.nan
 
         # Metal features
         metal_atoms = sum(amt for el, amt in el_amt.items() if is_metal(el))
@@ -51,8 +119,9 @@ def process_cif(cif_path_tuple):
 
         # Space group
         try:
+            structure = Structure(lattice_matrix, species, frac_coords)
             sga = SpacegroupAnalyzer(structure)
-            space_group, sg_num = sga.get_space_group_info()
+            space_group, sg_num = sga.get_space_group_symbol(), sga.get_space_group_number()
         except:
             space_group, sg_num = None, None
 
@@ -73,15 +142,21 @@ def process_cif(cif_path_tuple):
         }
 
         # One-hot encode common metals
-        common_metals = ["Zn", "Cu", "Zr", "Fe", "Co", "Ni", "Mn", "Cr", "V", "Al", "Mg", "Ca"]
-        for metal in common_metals:
+        for metal in COMMON_METALS:
             features[f"metal_{metal}"] = 1 if metal in el_amt else 0
 
-        return features, None
-
     except Exception as e:
         return None, (filename, str(e))
 
+    # Cache the parsed structure so steps 04 and 05 don't have to re-parse the CIF.
+    # A failed write only costs them a re-parse, so it must not drop the row.
+    try:
+        save_structure_arrays(cache_dir, mof_id, lattice_matrix, species, frac_coords, occupancies)
+    except OSError:
+        pass
+
+    return features, None
+
 def extract_chemical_features():
     """
     Main function to orchestrate the parallel extraction of chemical features
@@ -92,6 +167,7 @@ def extract_chemical_features():
     # --- CONFIGURATION ---
     cif_folder = os.path.join("MOFxDB_Project", "cifs")
     output_dir = os.path.join("MOFxDB_Project", "features", "chemical")
+    cache_dir = os.path.join("MOFxDB_Project", "cache", "structs")
     output_csv = os.path.join(output_dir, "chemical_features.csv")
     N_WORKERS = max(1, os.cpu_count() - 1)
 
@@ -102,38 +178,62 @@ def extract_chemical_features():
         return
 
     os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
 
     # Select all CoRE MOFs and a 15k subset of hMOFs
-    all_files = os.listdir(cif_folder)
-    core_files = [f for f in all_files if f.endswith(".cif") and not f.startswith("hMOF-")]
-    hmof_files = [f for f in all_files if f.endswith(".cif") and f.startswith("hMOF-")][:15000]
+    core_files, hmof_files = [], []
+    for name, _ in iter_files(cif_folder, ".cif"):
+        (hmof_files if name.startswith("hMOF-") else core_files).append(name)
+    # Sort before truncating so the hMOF subset doesn't depend on filesystem order
+    hmof_files.sort()
+    hmof_files = hmof_files[:15000]
     cif_files_to_process = core_files + hmof_files
     
     print(f"🧪 Processing {len(cif_files_to_process)} CIF files with {N_WORKERS} workers...")
 
     # --- PARALLEL EXECUTION ---
-    results = []
+    # Rows are streamed to the CSV as workers finish instead of being held in memory
+    n_extracted = 0
     errors = []
-    tasks = [(cif_folder, fname) for fname in cif_files_to_process]
-
-    with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
-        futures = {executor.submit(process_cif, task): task for task in tasks}
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing CIFs"):
-            result, error = future.result()
-            if result:
-                results.append(result)
-            if error:
-                errors.append(error)
-
-    # --- SAVE RESULTS ---
-    if not results:
+    tasks = [(cif_folder, fname, cache_dir) for fname in cif_files_to_process]
+
+    chunksize = task_chunksize(len(tasks), N_WORKERS)
+    # Warm up once in the parent; forked workers inherit this state, others warm up in _worker_init
+    _warm_up()
+    mp_context = get_mp_context()
+
+    # Share a single copy of the electronegativity table with all workers
+    en_table = build_en_table()
+    en_shm = shared_memory.SharedMemory(create=True, size=en_table.nbytes)
+    np.ndarray(en_table.shape, dtype=np.float64, buffer=en_shm.buf)[:] = en_table
+
+    try:
+        pool = ProcessPoolExecutor(
+            max_workers=N_WORKERS,
+            mp_context=mp_context,
+            initializer=_worker_init,
+            initargs=(en_shm.name, en_table.size, mp_context.get_start_method() != "fork"),
+        )
+        with open(output_csv, "w", newline="") as f, pool as executor:
+            writer = csv.DictWriter(f, fieldnames=CHEMICAL_COLUMNS)
+            writer.writeheader()
+            results_iter = executor.map(process_cif, tasks, chunksize=chunksize)
+            for result, error in tqdm(results_iter, total=len(tasks), desc="Processing CIFs"):
+                if result:
+                    writer.writerow(blank_nan(result))
+                    n_extracted += 1
+                if error:
+                    errors.append(error)
+    finally:
+        en_shm.close()
+        en_shm.unlink()
+
+    # --- SUMMARY ---
+    if not n_extracted:
         print("\n❌ Error: No chemical features were extracted. Check for errors during processing.")
         return
-        
-    df = pd.DataFrame(results)
-    df.to_csv(output_csv, index=False)
 
-    print(f"\n✅ Extracted features from {len(results)} / {len(cif_files_to_process)} CIFs.")
+    print(f"\n✅ Extracted features from {n_extracted} / {len(cif_files_to_process)} CIFs.")
     print(f"   - Output saved to: '{output_csv}'")
     if errors:
         print(f"   - Skipped {len(errors)} files due to errors. See error log for details.")
@@ -1,65 +1,119 @@
 # 04_extract_topological_features.py
 import os
+import csv
 import pandas as pd
 import numpy as np
 import multiprocessing
+import itertools
+import math
 import logging
-import networkx as nx
-from pymatgen.core import Structure
-from pymatgen.analysis.graphs import StructureGraph
-from pymatgen.analysis.local_env import CrystalNN
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import igraph as ig
+from numba import njit
+from scipy.spatial import cKDTree
 from tqdm import tqdm
-from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from fs_utils import blank_nan
+from cif_io import load_cif_index, load_structure_arrays, task_chunksize, get_mp_context
+
+# Distance (in Å) below which two atoms are treated as bonded in the MOF graph
+BOND_CUTOFF = 3.0
+
+# Fractional offsets of the 27 surrounding unit cells, used to find bonds across cell boundaries
+_IMAGE_OFFSETS = np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=np.float64)
+
+# Output column order of the topological feature table
+TOPOLOGICAL_COLUMNS = [
+    "MOF_ID",
+    "avg_node_connectivity",
+    "graph_density",
+    "num_connected_components",
+    "largest_cc_fraction",
+    "is_connected",
+    "clustering_coefficient_mean",
+    "degree_assortativity",
+    "graph_transitivity",
+    "graph_entropy",
+    "graph_diameter",
+    "graph_radius",
+    "avg_shortest_path_length",
+]
+
+def build_bond_edges(lattice_matrix, frac_coords, cutoff=BOND_CUTOFF):
+    """
+    Finds every pair of atoms closer than `cutoff`, including pairs bonded through
+    a periodic boundary, and returns them as a unique (n_edges, 2) array of indices.
+    """
+    n_atoms = len(frac_coords)
+    frac_coords = frac_coords % 1.0
+    cart_coords = frac_coords @ lattice_matrix
+    image_coords = ((frac_coords[None, :, :] + _IMAGE_OFFSETS[:, None, :]) @ lattice_matrix).reshape(-1, 3)
+
+    # Query the home cell against all periodic images in one KD-tree pass
+    pairs = cKDTree(cart_coords).sparse_distance_matrix(cKDTree(image_coords), cutoff, output_type="ndarray")
+    i, j = pairs["i"], pairs["j"] % n_atoms
+    keep = i < j  # Drops self-images and the mirrored copy of each bond
+    return np.unique(np.stack((i[keep], j[keep]), axis=1), axis=0)
+
+@njit(cache=True)
+def _entropy_from_counts(counts):
+    """Shannon entropy (in bits) of a histogram, skipping empty bins."""
+    total = counts.sum()
+    entropy = 0.0
+    for count in counts:
+        if count > 0:
+            p = count / total
+            entropy -= p * math.log2(p)
+    return entropy
 
 def extract_topo_features(cif_path_tuple):
     """
     Processes a single CIF file to extract topological features by representing
     the MOF structure as a mathematical graph.
     """
-    cif_folder, cif_file, mof_id = cif_path_tuple
-    cif_path = os.path.join(cif_folder, cif_file)
+    cif_folder, cif_file, mof_id, cache_dir = cif_path_tuple
 
     try:
         # Build the graph representation of the MOF
-        struct = Structure.from_file(cif_path)
-        cnn = CrystalNN()
-        sg = StructureGraph.with_local_env_strategy(struct, cnn)
-        g = nx.Graph(sg.graph)
-
-        is_connected = nx.is_connected(g)
-
-        # Calculate degrees and components
-        degrees = [d for _, d in g.degree()]
-        components = list(nx.connected_components(g))
-        largest_cc = max(components, key=len) if components else []
-        largest_cc_fraction = len(largest_cc) / g.number_of_nodes() if g.number_of_nodes() > 0 else 0
-
-        # Graph entropy calculation
-        degree_counts = Counter(dict(g.degree()).values())
-        total_nodes = sum(degree_counts.values())
-        probs = np.array([count / total_nodes for count in degree_counts.values()])
-        entropy = -np.sum(probs * np.log2(probs, where=probs>0))
+        lattice_matrix, species, frac_coords, occupancies = load_structure_arrays(cif_folder, cif_file, mof_id, cache_dir)
+        # Bonding isn't defined for partially occupied sites, so disordered MOFs are reported as failed
+        if np.any(occupancies < 1.0):
+            raise ValueError("structure has partially occupied sites")
+        n_atoms = len(species)
+        edges = build_bond_edges(lattice_matrix, frac_coords)
+        G = ig.Graph(n=n_atoms, edges=edges.tolist())
+
+        # Calculate degrees and components (each traversed only once)
+        degrees = np.array(G.degree(), dtype=np.int64)
+        components = G.connected_components()
+        n_components = len(components)
+        is_connected = n_components == 1
+        largest_cc_fraction = max(components.sizes()) / n_atoms if n_atoms > 0 else 0
+
+        # Graph entropy calculation from the degree histogram
+        entropy = _entropy_from_counts(np.bincount(degrees))
+
+        # Mean local clustering, streamed straight into a NumPy buffer
+        clustering = np.fromiter(G.transitivity_local_undirected(mode="zero"), dtype=np.float64, count=n_atoms)
 
         # Assemble feature dictionary
         result = {
             "MOF_ID": mof_id,
-            "avg_node_connectivity": np.mean(degrees) if degrees else 0,
-            "graph_density": nx.density(g),
-            "num_connected_components": nx.number_connected_components(g),
+            "avg_node_connectivity": degrees.mean() if n_atoms else 0,
+            "graph_density": G.density() if n_atoms > 1 else 0,
+            "num_connected_components": n_components,
             "largest_cc_fraction": largest_cc_fraction,
             "is_connected": int(is_connected),
-            "clustering_coefficient_mean": np.mean(list(nx.clustering(g).values())),
-            "degree_assortativity": nx.degree_assortativity_coefficient(g),
-            "graph_transitivity": nx.transitivity(g),
+            "clustering_coefficient_mean": clustering.mean(),
+            "degree_assortativity": G.assortativity_degree(directed=False),
+            "graph_transitivity": G.transitivity_undirected(mode="zero"),
             "graph_entropy": entropy,
         }
 
         # Features that only work for fully connected graphs
         if is_connected:
-            result["graph_diameter"] = nx.diameter(g)
-            result["graph_radius"] = nx.radius(g)
-            result["avg_shortest_path_length"] = nx.average_shortest_path_length(g)
+            result["graph_diameter"] = G.diameter(directed=False)
+            result["graph_radius"] = G.radius()
+            result["avg_shortest_path_length"] = G.average_path_length(directed=False)
         else:
             result["graph_diameter"] = -1
             result["graph_radius"] = -1
@@ -80,6 +134,8 @@ def extract_topological_features():
 
     # --- CONFIGURATION ---
     cif_folder = os.path.join("MOFxDB_Project", "cifs")
+    cif_index_path = os.path.join("MOFxDB_Project", "cif_index.pkl")
+    cache_dir = os.path.join("MOFxDB_Project", "cache", "structs")
     subset_csv = os.path.join("MOFxDB_Project", "features", "chemical", "chemical_features.csv")
     output_dir = os.path.join("MOFxDB_Project", "features", "topological")
     output_csv = os.path.join(output_dir, "topological_features.csv")
@@ -98,33 +154,42 @@ def extract_topological_features():
     # Load MOF IDs from the previous step to ensure we only process valid structures
     subset_df = pd.read_csv(subset_csv)
     mof_ids_to_process = set(subset_df["MOF_ID"].dropna().astype(str))
+    cif_index = load_cif_index(cif_index_path, cif_folder)
+    mof_ids_to_process &= cif_index  # Keep only MOFs whose CIF is available
+
+    # Tasks are generated lazily from the filtered ID set instead of being built up front
+    tasks = ((cif_folder, f"{mof_id}.cif", mof_id, cache_dir) for mof_id in mof_ids_to_process)
+    n_tasks = len(mof_ids_to_process)
     
-    tasks = [
-        (cif_folder, f"{mof_id}.cif", mof_id)
-        for mof_id in mof_ids_to_process
-        if os.path.exists(os.path.join(cif_folder, f"{mof_id}.cif"))
-    ]
-    
-    print(f"🧪 Processing {len(tasks)} CIF files with {N_WORKERS} workers...")
+    print(f"🧪 Processing {n_tasks} CIF files with {N_WORKERS} workers...")
 
     # --- PARALLEL EXECUTION ---
-    results = []
-    with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
-        futures = {executor.submit(extract_topo_features, task): task for task in tasks}
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Extracting Topology"):
-            result = future.result()
+    # Rows are streamed to the CSV as workers finish instead of being held in memory
+    n_written = 0
+    n_extracted = 0
+    chunksize = task_chunksize(n_tasks, N_WORKERS)
+    # JIT-compile the entropy kernel once here so forked workers don't each compile it
+    _entropy_from_counts(np.zeros(1, dtype=np.int64))
+    # Prefer 'fork' so workers inherit the parent's imports instead of re-importing them
+    mp_context = get_mp_context()
+    pool = ProcessPoolExecutor(max_workers=N_WORKERS, mp_context=mp_context)
+    with open(output_csv, "w", newline="") as f, pool as executor:
+        writer = csv.DictWriter(f, fieldnames=TOPOLOGICAL_COLUMNS)
+        writer.writeheader()
+        results_iter = executor.map(extract_topo_features, tasks, chunksize=chunksize)
+        for result in tqdm(results_iter, total=n_tasks, desc="Extracting Topology"):
             if result:
-                results.append(result)
+                writer.writerow(blank_nan(result))
+                n_written += 1
+                if len(result) > 1:  # Failed MOFs only carry their ID
+                    n_extracted += 1
 
-    # --- SAVE RESULTS ---
-    if not results:
+    # --- SUMMARY ---
+    if not n_written:
         print("\n❌ Error: No topological features were extracted.")
         return
-        
-    df = pd.DataFrame(results)
-    df.to_csv(output_csv, index=False)
     
-    print(f"\n✅ Extracted features from {len(df[df.columns.drop('MOF_ID')].dropna())} MOFs.")
+    print(f"\n✅ Extracted features from {n_extracted} MOFs.")
     print(f"   - Output saved to: '{output_csv}'")
     if os.path.getsize(error_log) > 0:
         print(f"   - Some errors occurred. See log: '{error_log}'")
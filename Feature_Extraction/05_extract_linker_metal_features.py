@@ -1,53 +1,72 @@
 # 05_extract_linker_metal_features.py
 import os
+import csv
 import pandas as pd
 import numpy as np
 import multiprocessing
-from pymatgen.core import Structure, Element
-from pymatgen.analysis.local_env import CrystalNN
+from ase import Atoms
+from ase.neighborlist import natural_cutoffs, neighbor_list
+from pymatgen.core import Element
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
+from fs_utils import blank_nan
+from cif_io import load_cif_index, load_structure_arrays, task_chunksize, get_mp_context
 
-def is_metal(symbol):
-    """Checks if an element symbol corresponds to a metal."""
-    try:
-        el = Element(symbol)
-        return el.is_metal
-    except:
-        return False
+# Symbols of all metallic elements, precomputed once at import
+_ALL_METAL_SYMBOLS = frozenset(el.symbol for el in Element if el.is_metal)
+
+# Checks if an element symbol corresponds to a metal
+is_metal = _ALL_METAL_SYMBOLS.__contains__
+
+# Scale applied to the covalent radii when deciding whether two atoms are bonded
+BOND_RADIUS_SCALE = 1.2
+
+# Output column order of the linker/metal feature table
+LINKER_METAL_COLUMNS = [
+    "MOF_ID",
+    "linker_atom_fraction",
+    "metal_coord_number_mean",
+    "metal_coord_number_std",
+]
+
+def _warm_up():
+    """
+    Warms up ASE's covalent-radius tables and neighbor-list code so the first
+    task in each worker doesn't pay for it.
+    """
+    atoms = Atoms("C", cell=[3.0, 3.0, 3.0], pbc=True)
+    neighbor_list("i", atoms, natural_cutoffs(atoms, mult=BOND_RADIUS_SCALE))
 
 def extract_linker_metal_features(cif_path_tuple):
     """
     Processes a single CIF file to extract features related to the metal centers
     and the organic linkers connecting them.
     """
-    cif_folder, cif_file, mof_id = cif_path_tuple
-    cif_path = os.path.join(cif_folder, cif_file)
+    cif_folder, cif_file, mof_id, cache_dir = cif_path_tuple
 
     try:
-        struct = Structure.from_file(cif_path)
-        cnn = CrystalNN()
+        lattice_matrix, species, frac_coords, occupancies = load_structure_arrays(cif_folder, cif_file, mof_id, cache_dir)
+        # Bonding isn't defined for partially occupied sites, so disordered MOFs are reported as failed
+        if np.any(occupancies < 1.0):
+            raise ValueError("structure has partially occupied sites")
+        atoms = Atoms(symbols=species.tolist(), scaled_positions=frac_coords, cell=lattice_matrix, pbc=True)
+        n_atoms = len(atoms)
 
         # Identify metal and linker atoms
-        metal_sites_indices = [i for i, site in enumerate(struct) if is_metal(site.specie.symbol)]
+        metal_mask = np.fromiter((is_metal(symbol) for symbol in species), dtype=bool, count=n_atoms)
         
         # Calculate linker atom fraction
-        linker_frac = 1.0 - (len(metal_sites_indices) / len(struct)) if len(struct) > 0 else np.nan
+        linker_frac = 1.0 - (metal_mask.sum() / n_atoms) if n_atoms > 0 else np.nan
 
-        # Calculate metal coordination numbers
-        metal_coord_numbers = []
-        for idx in metal_sites_indices:
-            try:
-                env = cnn.get_nn_info(struct, idx)
-                metal_coord_numbers.append(len(env))
-            except Exception:
-                continue # Skip if coordination env can't be found
+        # Calculate metal coordination numbers from a single neighbor list over all sites
+        centers = neighbor_list("i", atoms, natural_cutoffs(atoms, mult=BOND_RADIUS_SCALE))
+        metal_coord_numbers = np.bincount(centers, minlength=n_atoms)[metal_mask]
 
         return {
             "MOF_ID": mof_id,
             "linker_atom_fraction": linker_frac,
-            "metal_coord_number_mean": np.mean(metal_coord_numbers) if metal_coord_numbers else np.nan,
-            "metal_coord_number_std": np.std(metal_coord_numbers) if metal_coord_numbers else np.nan,
+            "metal_coord_number_mean": metal_coord_numbers.mean() if metal_coord_numbers.size else np.nan,
+            "metal_coord_number_std": metal_coord_numbers.std() if metal_coord_numbers.size else np.nan,
         }
 
     except Exception:
@@ -67,6 +86,8 @@ def run_linker_metal_extraction():
 
     # --- CONFIGURATION ---
     cif_folder = os.path.join("MOFxDB_Project", "cifs")
+    cif_index_path = os.path.join("MOFxDB_Project", "cif_index.pkl")
+    cache_dir = os.path.join("MOFxDB_Project", "cache", "structs")
     subset_csv = os.path.join("MOFxDB_Project", "features", "chemical", "chemical_features.csv")
     output_dir = os.path.join("MOFxDB_Project", "features", "linker_metal")
     output_csv = os.path.join(output_dir, "linker_metal_features.csv")
@@ -83,31 +104,37 @@ def run_linker_metal_extraction():
     # Load MOF IDs from the previous step
     subset_df = pd.read_csv(subset_csv)
     mof_ids_to_process = set(subset_df["MOF_ID"].dropna().astype(str))
+    cif_index = load_cif_index(cif_index_path, cif_folder)
+    mof_ids_to_process &= cif_index  # Keep only MOFs whose CIF is available
+
+    # Tasks are generated lazily from the filtered ID set instead of being built up front
+    tasks = ((cif_folder, f"{mof_id}.cif", mof_id, cache_dir) for mof_id in mof_ids_to_process)
+    n_tasks = len(mof_ids_to_process)
     
-    tasks = [
-        (cif_folder, f"{mof_id}.cif", mof_id)
-        for mof_id in mof_ids_to_process
-        if os.path.exists(os.path.join(cif_folder, f"{mof_id}.cif"))
-    ]
-    
-    print(f"🧪 Processing {len(tasks)} CIF files with {N_WORKERS} workers...")
+    print(f"🧪 Processing {n_tasks} CIF files with {N_WORKERS} workers...")
 
     # --- PARALLEL EXECUTION ---
-    results = []
-    with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
-        futures = {executor.submit(extract_linker_metal_features, task): task for task in tasks}
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Extracting Linker/Metal Features"):
-            result = future.result()
+    # Rows are streamed to the CSV as workers finish instead of being held in memory
+    n_written = 0
+    chunksize = task_chunksize(n_tasks, N_WORKERS)
+    # Warm up once in the parent; forked workers inherit this state, others warm up on start
+    _warm_up()
+    mp_context = get_mp_context()
+    initializer = None if mp_context.get_start_method() == "fork" else _warm_up
+    pool = ProcessPoolExecutor(max_workers=N_WORKERS, mp_context=mp_context, initializer=initializer)
+    with open(output_csv, "w", newline="") as f, pool as executor:
+        writer = csv.DictWriter(f, fieldnames=LINKER_METAL_COLUMNS)
+        writer.writeheader()
+        results_iter = executor.map(extract_linker_metal_features, tasks, chunksize=chunksize)
+        for result in tqdm(results_iter, total=n_tasks, desc="Extracting Linker/Metal Features"):
             if result:
-                results.append(result)
+                writer.writerow(blank_nan(result))
+                n_written += 1
 
-    # --- SAVE RESULTS ---
-    if not results:
+    # --- SUMMARY ---
+    if not n_written:
         print("\n❌ Error: No linker/metal features were extracted.")
         return
-        
-    df = pd.DataFrame(results)
-    df.to_csv(output_csv, index=False)
     
     print(f"\n✅ Linker and metal features saved to: '{output_csv}'")
 
@@ -0,0 +1,70 @@
+# cif_io.py
+"""Structure-loading and task helpers shared by the feature extraction scripts."""
+import os
+import pickle
+import multiprocessing
+import gemmi
+import numpy as np
+from pymatgen.core import Lattice
+from fs_utils import iter_files
+
+def read_cif_arrays(cif_path):
+    """
+    Parses a CIF file with gemmi's C++ reader and returns the lattice matrix,
+    the element symbol, fractional coordinates and occupancy of every site as NumPy arrays.
+    """
+    small = gemmi.read_small_structure(cif_path)
+    sites = small.get_all_unit_cell_sites()  # Applies the symmetry operations
+    cell = small.cell
+    lattice_matrix = Lattice.from_parameters(cell.a, cell.b, cell.c, cell.alpha, cell.beta, cell.gamma).matrix
+    species = np.array([site.element.name for site in sites])
+    frac_coords = np.array([[site.fract.x, site.fract.y, site.fract.z] for site in sites], dtype=np.float64)
+    occupancies = np.array([site.occ for site in sites], dtype=np.float64)
+    return lattice_matrix, species, frac_coords, occupancies
+
+def load_cif_index(cif_index_path, cif_folder):
+    """
+    Loads the set of available MOF IDs written by '01_prepare_dataset.py',
+    falling back to a single scan of the CIF folder if the index is missing.
+    """
+    if os.path.exists(cif_index_path):
+        with open(cif_index_path, "rb") as f:
+            return pickle.load(f)
+    return {name[:-len(".cif")] for name, _ in iter_files(cif_folder, ".cif")}
+
+def save_structure_arrays(cache_dir, mof_id, lattice_matrix, species, frac_coords, occupancies):
+    """
+    Caches the parsed structure of a MOF for 'load_structure_arrays'. The pickle is
+    written to a temporary file first and then renamed, so readers never see a partial file.
+    """
+    cache_path = os.path.join(cache_dir, f"{mof_id}.pkl")
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump((lattice_matrix, species.tolist(), frac_coords, occupancies), f, protocol=5)
+    os.replace(tmp_path, cache_path)
+
+def load_structure_arrays(cif_folder, cif_file, mof_id, cache_dir):
+    """
+    Loads the lattice matrix, species, fractional coordinates and occupancies cached by
+    '03_extract_chemical_features.py', re-parsing the CIF if the cache is missing or unreadable.
+    """
+    try:
+        with open(os.path.join(cache_dir, f"{mof_id}.pkl"), "rb") as f:
+            lattice_matrix, species, frac_coords, occupancies = pickle.load(f)
+        return lattice_matrix, np.array(species), frac_coords, occupancies
+    except Exception:  # Missing, truncated or stale cache entry
+        return read_cif_arrays(os.path.join(cif_folder, cif_file))
+
+def task_chunksize(n_tasks, n_workers):
+    """
+    Returns the number of tasks to dispatch per batch, about eight batches per
+    worker, which cuts per-task pickling and queue overhead.
+    """
+    return max(1, n_tasks // (n_workers * 8))
+
+def get_mp_context():
+    """
+    Returns the 'fork' multiprocessing context where available, so workers inherit the
+    parent's imports and warmed-up state, and the platform default otherwise.
+    """
+    return multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
@@ -0,0 +1,15 @@
+# fs_utils.py
+"""File and CSV helpers shared by the pipeline scripts. Kept free of heavy imports."""
+import os
+import math
+
+def iter_files(folder, suffix):
+    """Yields (name, path) pairs for the files in a folder ending with the given suffix."""
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.name.endswith(suffix) and entry.is_file():
+                yield entry.name, entry.path
+
+def blank_nan(row):
+    """Returns a copy of a CSV row with NaN values written as empty cells, as pandas' to_csv does."""
+    return {key: "" if isinstance(value, float) and math.isnan(value) else value for key, value in row.items()}